@@ -51,6 +51,10 @@ def create_app() -> Flask:
     if not (os.environ.get("ADMIN_PASSWORD") or "").strip():
         raise RuntimeError("ADMIN_PASSWORD is required. Set it in .env")
 
+    # MD5 is a legacy display checksum; off by default since it costs a second digest per byte
+    compute_md5 = (os.environ.get("COMPUTE_MD5") or "").lower()
+    app.config["COMPUTE_MD5"] = compute_md5 in {"1", "true", "yes"}
+
     # Paths
     app.config["BASE_DIR"] = base_dir
     app.config["UPLOAD_DIR"] = base_dir / "uploads"
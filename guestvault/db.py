@@ -1,19 +1,116 @@
 from __future__ import annotations
 
+import atexit
+import logging
+import os
+import queue
 import sqlite3
-from flask import current_app
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, ContextManager, Iterator
 
+from flask import current_app, g
 
-def get_db_connection() -> sqlite3.Connection:
-    path = current_app.config["DB_PATH"]
-    conn = sqlite3.connect(path)
+if TYPE_CHECKING:
+    from .storage import FileMeta
+
+# Idle connections kept per database file. Opening a connection costs far more
+# than checking one out, so routes borrow from this pool instead.
+_POOL_SIZE = 10
+_pools: dict[tuple[int, str], queue.LifoQueue] = {}
+_pools_lock = threading.Lock()
+
+# Download counters are aggregated in memory and written in one transaction
+# every few seconds instead of committing once per download.
+_DL_FLUSH_INTERVAL = 5.0
+_dl_deltas: Counter[tuple[str, int]] = Counter()
+_dl_lock = threading.Lock()
+_dl_flusher_pid: int | None = None
+
+
+def _get_pool(path: str) -> queue.LifoQueue:
+    # Keyed by pid too so a forked worker never reuses its parent's connections
+    key = (os.getpid(), path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, queue.LifoQueue(maxsize=_POOL_SIZE))
+    return pool
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # Per-connection tuning; paid once per pooled connection. WAL makes NORMAL
+    # durable across application crashes, and mmap lets reads skip a copy.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
     return conn
 
 
-def init_db() -> None:
-    conn = get_db_connection()
+def _acquire(pool: queue.LifoQueue, path: str) -> sqlite3.Connection:
+    try:
+        return pool.get_nowait()
+    except queue.Empty:
+        return _connect(path)
+
+
+def _release(pool: queue.LifoQueue, conn: sqlite3.Connection) -> None:
+    try:
+        pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def _scoped(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
     try:
+        yield conn
+    finally:
+        # Never leave a half-finished transaction behind for the next user
+        if conn.in_transaction:
+            conn.rollback()
+
+
+@contextmanager
+def _checkout(path: str) -> Iterator[sqlite3.Connection]:
+    pool = _get_pool(path)
+    conn = _acquire(pool, path)
+    try:
+        with _scoped(conn):
+            yield conn
+    finally:
+        _release(pool, conn)
+
+
+def get_db_connection() -> ContextManager[sqlite3.Connection]:
+    # One pooled connection per app context (i.e. per request), shared by every
+    # query in it and handed back in close_db_connection() at teardown
+    conn = g.get("_db_conn")
+    if conn is None:
+        path = str(current_app.config["DB_PATH"])
+        g._db_pool = pool = _get_pool(path)
+        g._db_conn = conn = _acquire(pool, path)
+    return _scoped(conn)
+
+
+def close_db_connection(_exc: BaseException | None = None) -> None:
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        _release(g.pop("_db_pool"), conn)
+
+
+def init_db() -> None:
+    with get_db_connection() as conn:
+        # WAL is persistent in the database file, so setting it once is enough.
+        # Readers no longer block the writer (uploads, download counters).
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS files (
@@ -23,7 +120,7 @@ def init_db() -> None:
                 content_type TEXT,
                 size INTEGER NOT NULL,
                 sha256 TEXT NOT NULL,
-                md5 TEXT,
+                md5 TEXT,  -- optional display checksum, only filled when COMPUTE_MD5 is on
                 encrypted INTEGER NOT NULL DEFAULT 0,
                 uploaded_at TEXT NOT NULL,
                 download_count INTEGER NOT NULL DEFAULT 0
@@ -38,13 +135,10 @@ def init_db() -> None:
             # Column likely already exists; ignore
             pass
         conn.commit()
-    finally:
-        conn.close()
 
 
-def insert_file_record(meta: dict) -> int:
-    conn = get_db_connection()
-    try:
+def insert_file_record(meta: FileMeta) -> int:
+    with get_db_connection() as conn:
         cur = conn.execute(
             """
             INSERT INTO files (
@@ -52,49 +146,103 @@ def insert_file_record(meta: dict) -> int:
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
-                meta["filename_original"],
-                meta["stored_relpath"],
-                meta.get("content_type"),
-                meta["size"],
-                meta["sha256"],
-                meta.get("md5"),
-                1 if meta.get("encrypted") else 0,
-                meta["uploaded_at"],
+                meta.filename_original,
+                meta.stored_relpath,
+                meta.content_type,
+                meta.size,
+                meta.sha256,
+                meta.md5,
+                1 if meta.encrypted else 0,
+                meta.uploaded_at,
             ),
         )
         conn.commit()
         return int(cur.lastrowid)
-    finally:
-        conn.close()
 
 
 def list_files():
-    conn = get_db_connection()
-    try:
+    with get_db_connection() as conn:
         rows = conn.execute(
             "SELECT * FROM files ORDER BY datetime(uploaded_at) DESC, id DESC"
         ).fetchall()
         return rows
-    finally:
-        conn.close()
+
+
+def list_files_for_index():
+    # Only the columns index.html renders. Ids are assigned in upload order, so
+    # ordering by the rowid gives the same listing without a per-row datetime() sort.
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT id, filename_original, size, sha256, encrypted, uploaded_at, download_count
+            FROM files ORDER BY id DESC
+            """
+        ).fetchall()
+        return rows
+
+
+def files_generation() -> tuple:
+    # Cheap change token for the index page: inserts bump MAX(id), deletes change
+    # COUNT(*), downloads change the SUM. Far cheaper than fetching and rendering rows.
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT MAX(id), COUNT(*), TOTAL(download_count) FROM files"
+        ).fetchone()
+        return tuple(row)
 
 
 def get_file(file_id: int):
-    conn = get_db_connection()
-    try:
+    with get_db_connection() as conn:
         row = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
         return row
-    finally:
-        conn.close()
+
+
+def flush_download_counts() -> None:
+    with _dl_lock:
+        pending = dict(_dl_deltas)
+        _dl_deltas.clear()
+    by_path: dict[str, list[tuple[int, int]]] = {}
+    for (path, file_id), delta in pending.items():
+        by_path.setdefault(path, []).append((delta, file_id))
+    for path, params in by_path.items():
+        try:
+            with _checkout(path) as conn:
+                conn.executemany(
+                    "UPDATE files SET download_count = download_count + ? WHERE id = ?",
+                    params,
+                )
+                conn.commit()
+        except sqlite3.Error:
+            logging.exception("Failed to flush download counts; will retry")
+            with _dl_lock:
+                for delta, file_id in params:
+                    _dl_deltas[(path, file_id)] += delta
+
+
+def _download_flush_loop() -> None:
+    while True:
+        time.sleep(_DL_FLUSH_INTERVAL)
+        flush_download_counts()
+
+
+def _ensure_download_flusher() -> None:
+    # Started lazily so each (possibly forked) worker process runs its own flusher
+    global _dl_flusher_pid
+    pid = os.getpid()
+    if _dl_flusher_pid == pid:
+        return
+    with _dl_lock:
+        if _dl_flusher_pid == pid:
+            return
+        _dl_flusher_pid = pid
+    threading.Thread(target=_download_flush_loop, name="guestvault-dl-flush", daemon=True).start()
 
 
 def increment_download_count(file_id: int) -> None:
-    conn = get_db_connection()
-    try:
-        conn.execute(
-            "UPDATE files SET download_count = download_count + 1 WHERE id = ?",
-            (file_id,),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    _ensure_download_flusher()
+    key = (str(current_app.config["DB_PATH"]), file_id)
+    with _dl_lock:
+        _dl_deltas[key] += 1
+
+
+atexit.register(flush_download_counts)
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import dataclasses
+import hashlib
+import hmac
 import os
 from pathlib import Path
 from typing import Any
@@ -22,10 +25,12 @@ from datetime import datetime
 from .db import (
     init_db,
     insert_file_record,
-    list_files,
+    list_files_for_index,
+    files_generation,
     get_file,
     increment_download_count,
     get_db_connection,
+    close_db_connection,
 )
 from .security import (
     generate_csrf_token,
@@ -33,17 +38,8 @@ from .security import (
     require_admin,
     get_login_rate_limiter,
 )
-from .storage import ensure_dirs, store_file, delete_blob_if_unreferenced
-
-
-def human_size(num: int) -> str:
-    units = ["B", "KB", "MB", "GB", "TB"]
-    size = float(num)
-    for unit in units:
-        if size < 1024.0:
-            return f"{size:.2f} {unit}"
-        size /= 1024.0
-    return f"{size:.2f} PB"
+from .storage import ensure_dirs, get_paths, store_file, delete_blob_if_unreferenced
+from .util import human_size, preview_class
 
 
 def set_security_headers(response):
@@ -60,6 +56,11 @@ def set_security_headers(response):
     return response
 
 
+# A file id always maps to the same content-addressed blob, so clients may cache
+# it for good. "private" keeps shared caches from serving a file after deletion.
+BLOB_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
 def set_raw_sandbox_headers(response):
     response.headers["Content-Security-Policy"] = "sandbox"
     response.headers["X-Content-Type-Options"] = "nosniff"
@@ -87,11 +88,37 @@ def init_app(app: Flask) -> None:
         }
 
     app.after_request(set_security_headers)
+    app.teardown_appcontext(close_db_connection)
 
     @app.get("/")
     def index():
-        files = list_files()
-        return render_template("index.html", files=files)
+        # The page depends on the file table and on who is viewing it (admin
+        # controls, CSRF token), so all of those feed the validator.
+        generation = ":".join(map(str, files_generation()))
+        viewer = f"{session.get('is_admin', False)}:{generate_csrf_token()}"
+        etag = hashlib.blake2b(f"{generation}:{viewer}".encode(), digest_size=8).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            resp = make_response("", 304)
+        else:
+            # Project rows into plain dicts with display strings preformatted, so
+            # the template does no row-mapping lookups or filter calls per file
+            files = [
+                {
+                    "id": r[0],
+                    "name": r[1],
+                    "size_h": human_size(r[2]),
+                    "sha_short": r[3][:12],
+                    "encrypted": r[4],
+                    "uploaded": r[5],
+                    "downloads": r[6],
+                }
+                for r in list_files_for_index()
+            ]
+            resp = make_response(render_template("index.html", files=files))
+        resp.set_etag(etag, weak=True)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        resp.vary.add("Cookie")
+        return resp
 
     @app.post("/upload")
     def upload():
@@ -104,21 +131,15 @@ def init_app(app: Flask) -> None:
         filename = secure_filename(file.filename)
         meta, _abs_path = store_file(file, filename)
         # Optional client-side encryption marker
-        try:
-            enc_flag = request.form.get("encrypted", "0")
-            meta["encrypted"] = True if str(enc_flag) == "1" else False
-        except Exception:
-            meta["encrypted"] = False
-        # Optional anonymize filename: replace displayed original filename with md5 hash to avoid duplicates (keep extension)
-        try:
-            anon_flag = request.form.get("anonymize", "0")
-            if str(anon_flag) == "1":
-                import os as _os
-            _root, _ext = _os.path.splitext(meta.get("filename_original") or filename)
-            _md5 = meta.get("md5") or "file"
-            meta["filename_original"] = f"{_md5}{_ext}" if _ext else _md5
-        except Exception:
-            pass
+        encrypted = request.form.get("encrypted", "0") == "1"
+        # Optional anonymize filename: replace the displayed original filename with a
+        # sha256 prefix to avoid duplicates (keep extension)
+        display_name = meta.filename_original
+        if request.form.get("anonymize", "0") == "1":
+            _root, ext = os.path.splitext(display_name)
+            digest = meta.sha256[:32]
+            display_name = f"{digest}{ext}" if ext else digest
+        meta = dataclasses.replace(meta, filename_original=display_name, encrypted=encrypted)
         file_id = insert_file_record(meta)
         return redirect(url_for("file_detail", file_id=file_id))
 
@@ -127,21 +148,7 @@ def init_app(app: Flask) -> None:
         row = get_file(file_id)
         if not row:
             abort(404)
-        ct = row["content_type"] or "application/octet-stream"
-        is_image = ct.startswith("image/")
-        is_text = ct.startswith("text/") or ct in ("application/json", "application/xml")
-        is_json = ct == "application/json"
-        is_audio = ct.startswith("audio/")
-        is_video = ct.startswith("video/")
-        return render_template(
-            "detail.html",
-            file=row,
-            is_image=is_image,
-            is_text=is_text,
-            is_json=is_json,
-            is_audio=is_audio,
-            is_video=is_video,
-        )
+        return render_template("detail.html", file=row, preview=preview_class(row["content_type"]))
 
     @app.get("/download/<int:file_id>")
     def download(file_id: int):
@@ -149,10 +156,19 @@ def init_app(app: Flask) -> None:
         if not row:
             abort(404)
         rel = row["stored_relpath"]
-        directory = Path(app.config["UPLOAD_DIR"]) / Path(rel).parent
+        directory = get_paths()["upload"] / Path(rel).parent
         filename = Path(rel).name
         increment_download_count(file_id)
-        return send_from_directory(directory, filename, as_attachment=True, download_name=row["filename_original"])
+        resp = send_from_directory(
+            directory,
+            filename,
+            as_attachment=True,
+            download_name=row["filename_original"],
+            conditional=True,
+            etag=row["sha256"],
+        )
+        resp.headers["Cache-Control"] = BLOB_CACHE_CONTROL
+        return resp
 
     @app.get("/raw/<int:file_id>")
     def raw(file_id: int):
@@ -160,9 +176,12 @@ def init_app(app: Flask) -> None:
         if not row:
             abort(404)
         rel = row["stored_relpath"]
-        directory = Path(app.config["UPLOAD_DIR"]) / Path(rel).parent
+        directory = get_paths()["upload"] / Path(rel).parent
         filename = Path(rel).name
-        resp = make_response(send_from_directory(directory, filename))
+        # Keep the send_file response as-is so WSGI servers can hand its
+        # wsgi.file_wrapper body to sendfile(2)
+        resp = send_from_directory(directory, filename, conditional=True, etag=row["sha256"])
+        resp.headers["Cache-Control"] = BLOB_CACHE_CONTROL
         return set_raw_sandbox_headers(resp)
 
     @app.post("/files/<int:file_id>/delete")
@@ -173,12 +192,9 @@ def init_app(app: Flask) -> None:
         if not row:
             abort(404)
         # Delete DB row
-        conn = get_db_connection()
-        try:
+        with get_db_connection() as conn:
             conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
             conn.commit()
-        finally:
-            conn.close()
         delete_blob_if_unreferenced(row["sha256"], row["stored_relpath"])
         flash("File deleted.", "success")
         return redirect(url_for("index"))
@@ -197,20 +213,17 @@ def init_app(app: Flask) -> None:
         if not ids:
             return redirect(url_for("index"))
 
-        conn = get_db_connection()
-        rows = []
-        try:
-            for fid in ids:
-                row = conn.execute(
-                    "SELECT id, sha256, stored_relpath FROM files WHERE id = ?",
-                    (fid,),
-                ).fetchone()
-                if row:
-                    rows.append(row)
-                    conn.execute("DELETE FROM files WHERE id = ?", (fid,))
+        ids = list(dict.fromkeys(ids))
+
+        # One SELECT and one DELETE for the whole selection, in a single transaction
+        placeholders = ",".join("?" * len(ids))
+        with get_db_connection() as conn:
+            rows = conn.execute(
+                f"SELECT id, sha256, stored_relpath FROM files WHERE id IN ({placeholders})",
+                ids,
+            ).fetchall()
+            conn.execute(f"DELETE FROM files WHERE id IN ({placeholders})", ids)
             conn.commit()
-        finally:
-            conn.close()
         for r in rows:
             delete_blob_if_unreferenced(r["sha256"], r["stored_relpath"])
         flash(f"Deleted {len(rows)} file(s).", "success")
@@ -224,11 +237,13 @@ def init_app(app: Flask) -> None:
     def admin_login_post():
         validate_csrf_from_request()
         limiter = get_login_rate_limiter()
-        ip = request.headers.get("X-Forwarded-For", request.remote_addr or "?").split(",")[0].strip()
+        # ProxyFix (BEHIND_PROXY=1) already resolves the client address from X-Forwarded-For
+        ip = request.remote_addr or "?"
         if not limiter.check(ip):
             abort(429, description="Too many attempts. Try later.")
         password = request.form.get("password", "")
-        if password and password == os.environ.get("ADMIN_PASSWORD"):
+        expected = os.environ.get("ADMIN_PASSWORD") or ""
+        if password and expected and hmac.compare_digest(password.encode(), expected.encode()):
             session["is_admin"] = True
             flash("Logged in.", "success")
             return redirect(url_for("index"))
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
+import hmac
 import os
 import time
 import secrets
-from collections import deque, defaultdict
-from typing import Deque, Dict
+import threading
+from collections import OrderedDict
+from typing import List
 
-from flask import session, request, abort
+from flask import g, session, request, abort
 
 
 def require_admin() -> None:
@@ -15,15 +17,22 @@ def require_admin() -> None:
 
 
 def generate_csrf_token() -> str:
+    # Memoized on g: the context processor and index() both ask for it per request
+    token = g.get("_csrf")
+    if token:
+        return token
     token = session.get("csrf_token")
     if not token:
-        token = secrets.token_hex(32)
+        # 192 bits in 32 URL-safe characters keeps the session cookie small
+        token = secrets.token_urlsafe(24)
         session["csrf_token"] = token
+    g._csrf = token
     return token
 
 
 def validate_csrf_token(token: str | None) -> None:
-    if not token or token != session.get("csrf_token"):
+    expected = session.get("csrf_token")
+    if not token or not expected or not hmac.compare_digest(token.encode(), expected.encode()):
         abort(400, description="Invalid CSRF token")
 
 
@@ -32,22 +41,46 @@ def validate_csrf_from_request() -> None:
     validate_csrf_token(token)
 
 
+class _Ring:
+    __slots__ = ("idx", "filled", "stamps")
+
+    def __init__(self, size: int) -> None:
+        self.idx = 0
+        self.filled = 0
+        self.stamps: List[float] = [0.0] * size
+
+
 class RateLimiter:
-    def __init__(self, attempts: int, window_seconds: int) -> None:
+    # Sliding-window limiter. Each key keeps a fixed ring of its last `attempts`
+    # timestamps, and at most `max_keys` keys are tracked (least recently seen
+    # are evicted), so memory stays bounded no matter how many clients show up.
+    def __init__(self, attempts: int, window_seconds: int, max_keys: int = 4096) -> None:
         self.attempts = attempts
         self.window = window_seconds
-        self.buckets: Dict[str, Deque[float]] = defaultdict(deque)
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[str, _Ring] = OrderedDict()
+        self._lock = threading.Lock()
 
     def check(self, key: str) -> bool:
-        now = time.time()
-        q = self.buckets[key]
-        # prune
-        while q and (now - q[0]) > self.window:
-            q.popleft()
-        if len(q) >= self.attempts:
+        if self.attempts <= 0:
             return False
-        q.append(now)
-        return True
+        now = time.time()
+        with self._lock:
+            ring = self.buckets.get(key)
+            if ring is None:
+                ring = self.buckets[key] = _Ring(self.attempts)
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            # Once the ring is full, the slot about to be overwritten is the oldest
+            if ring.filled == self.attempts and (now - ring.stamps[ring.idx]) <= self.window:
+                return False
+            ring.stamps[ring.idx] = now
+            ring.idx = (ring.idx + 1) % self.attempts
+            if ring.filled < self.attempts:
+                ring.filled += 1
+            return True
 
 
 def get_login_rate_limiter() -> RateLimiter:
@@ -1,60 +1,277 @@
 from __future__ import annotations
 
 import hashlib
+import logging
+import mmap
 import os
-from datetime import datetime, timezone
+import secrets
+import time
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from typing import BinaryIO, Tuple
 
 from flask import current_app
 
+# Werkzeug keeps uploads under 500 KB in memory and spools larger ones to a real
+# temporary file. Those are hashed and copied straight from a read-only mapping
+# of the spool file, skipping the copy into a userspace buffer.
+_MMAP_MIN_SIZE = 1024 * 1024
+# Each chunk is read twice back to back (hash, then write). 256 KiB fits in a
+# typical per-core L2, so the write is served from cache rather than DRAM.
+_HASH_CHUNK = 256 * 1024
+# Large new blobs are synced and evicted from the page cache once written, so a
+# burst of uploads doesn't push the DB and hot previews out of memory
+_DROP_CACHE_MIN_SIZE = 8 * 1024 * 1024
+_TMP_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+
+@dataclass(slots=True, frozen=True)
+class FileMeta:
+    filename_original: str
+    stored_relpath: str
+    content_type: str | None
+    size: int
+    sha256: str
+    # None unless COMPUTE_MD5 is enabled (display-only, non-security)
+    md5: str | None
+    uploaded_at: str
+    encrypted: bool = False
+
+
+def get_paths() -> dict[str, Path]:
+    # Config is fixed after create_app(), so the Path objects are built once per app
+    paths = current_app.extensions.get("guestvault_paths")
+    if paths is None:
+        paths = current_app.extensions["guestvault_paths"] = {
+            "upload": Path(current_app.config["UPLOAD_DIR"]),
+            "db": Path(current_app.config["DB_PATH"]),
+        }
+    return paths
+
 
 def ensure_dirs() -> None:
-    Path(current_app.config["UPLOAD_DIR"]).mkdir(parents=True, exist_ok=True)
-    Path(Path(current_app.config["DB_PATH"]).parent).mkdir(parents=True, exist_ok=True)
+    paths = get_paths()
+    paths["upload"].mkdir(parents=True, exist_ok=True)
+    # All 256 sha256 prefix dirs up front, so uploads never need a mkdir
+    for i in range(256):
+        (paths["upload"] / f"{i:02x}").mkdir(exist_ok=True)
+    paths["db"].parent.mkdir(parents=True, exist_ok=True)
+
+
+def _map_upload(f: BinaryIO) -> Tuple[mmap.mmap, int] | None:
+    try:
+        start = f.tell()
+        end = f.seek(0, os.SEEK_END)
+        f.seek(start)
+        # Size gate first: fileno() on an in-memory SpooledTemporaryFile would
+        # force it to roll over to disk.
+        if end - start < _MMAP_MIN_SIZE:
+            return None
+        f.flush()
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm, start
 
 
-def _hash_fileobj(f: BinaryIO) -> Tuple[str, str, int]:
-    # Compute content hashes for display. SHA-256 is the integrity hash.
-    # MD5 is included ONLY as a legacy checksum for convenience in UIs/tools,
-    # not for any security purpose.  # nosec B303
+def _copy_range(src_fd: int, dst_fd: int, src_off: int, dst_off: int, count: int) -> bool:
+    # In-kernel copy (a reflink on CoW filesystems); False if the kernel or the
+    # filesystem pair can't do it, so the caller falls back to write().
+    try:
+        while count:
+            n = os.copy_file_range(src_fd, dst_fd, count, src_off, dst_off)
+            if not n:
+                return False
+            src_off += n
+            dst_off += n
+            count -= n
+    except OSError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def _can_link_unnamed(directory: str) -> bool:
+    # O_TMPFILE needs filesystem support, and linking it into place needs a
+    # mounted /proc that allows linkat() through /proc/self/fd; probe once.
+    if not hasattr(os, "O_TMPFILE"):
+        return False
+    try:
+        fd = os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o666)
+    except OSError:
+        return False
+    # Unique per call: concurrent first uploads must not collide on the name and
+    # have lru_cache keep a spurious False
+    probe = os.path.join(directory, f".tmpfile-probe-{secrets.token_hex(16)}")
+    try:
+        os.link(f"/proc/self/fd/{fd}", probe, follow_symlinks=True)
+        os.unlink(probe)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def _open_unnamed(directory: Path) -> int | None:
+    # An O_TMPFILE inode has no name until it is linked, so a crash mid-upload
+    # leaves nothing behind in UPLOAD_DIR
+    if not _can_link_unnamed(str(directory)):
+        return None
+    try:
+        return os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o666)
+    except OSError:
+        return None
+
+
+def _link_unnamed(fd: int, abs_path: Path) -> None:
+    # Must run while fd is still open; the mkstemp fallback is renamed by the
+    # caller only after closing, since Windows can't rename an open file
+    proc_path = f"/proc/self/fd/{fd}"
+    try:
+        os.link(proc_path, abs_path, follow_symlinks=True)
+    except FileExistsError:
+        # A blob of a different size is in the way; swap it out atomically
+        tmp_name = abs_path.with_name(f".{abs_path.name}.{os.getpid()}.{fd}.tmp")
+        os.link(proc_path, tmp_name, follow_symlinks=True)
+        os.replace(tmp_name, abs_path)
+
+
+def _hash_and_store(f: BinaryIO, filename_sanitized: str) -> Tuple[str, str | None, int, str]:
+    # Single pass over the upload: every chunk is hashed and written to a temp
+    # file in UPLOAD_DIR, which is then linked/renamed into its content-addressed slot.
+    # SHA-256 is the integrity hash and dedup key. MD5 is an opt-in legacy display
+    # checksum (COMPUTE_MD5), not used for any security purpose.  # nosec B303
+    upload_dir = get_paths()["upload"]
+    # Deliberately a plain SHA-256 rather than a parallel tree hash: the digest is
+    # shown to users and names every existing blob. update() releases the GIL, so
+    # concurrent uploads already hash on separate cores. hashlib uses OpenSSL's EVP
+    # SHA-256, which picks SHA-NI/AVX2 code at runtime; no custom binding is needed.
     sha256 = hashlib.sha256()
-    md5 = hashlib.md5()  # nosec B303: non-security display checksum
+    md5 = hashlib.md5() if current_app.config.get("COMPUTE_MD5") else None  # nosec B303
     size = 0
-    for chunk in iter(lambda: f.read(1024 * 1024), b""):
-        sha256.update(chunk)
-        md5.update(chunk)
-        size += len(chunk)
-    f.seek(0)
-    return sha256.hexdigest(), md5.hexdigest(), size
+    tmp_path = None
+    fd = _open_unnamed(upload_dir)
+    if fd is None:
+        # Not mkstemp(): its 0600 would stick to the blob. With 0o666 the kernel
+        # applies the umask, as it did for FileStorage.save().
+        tmp_path = str(upload_dir / f".upload-{secrets.token_hex(16)}.tmp")
+        fd = os.open(tmp_path, _TMP_FLAGS, 0o666)
+    try:
+        # Writes of a full chunk bypass BufferedWriter's internal copy.
+        with os.fdopen(fd, "wb") as out:
+            # Bound once; the loops below call these for every chunk. With COMPUTE_MD5
+            # on, MD5 is updated serially after SHA-256: it is an opt-in legacy display
+            # checksum, not worth a second hashing thread to overlap the two.
+            sha_update = sha256.update
+            md5_update = md5.update if md5 is not None else None
+            write = out.write
+            mapped = _map_upload(f)
+            if mapped is not None:
+                # Hash from the mapping and let the kernel copy the same range, so
+                # the bytes never get copied through a userspace buffer
+                mm, start = mapped
+                src_fd = f.fileno()
+                kernel_copy = hasattr(os, "copy_file_range")
+                with mm, memoryview(mm) as whole:
+                    for off in range(start, len(whole), _HASH_CHUNK):
+                        # Released on any exit, so closing the map can't mask an error
+                        with whole[off : off + _HASH_CHUNK] as chunk:
+                            sha_update(chunk)
+                            if md5_update is not None:
+                                md5_update(chunk)
+                            if kernel_copy:
+                                kernel_copy = _copy_range(
+                                    src_fd, fd, off, off - start, len(chunk)
+                                )
+                                if not kernel_copy:
+                                    out.seek(off - start)
+                            if not kernel_copy:
+                                write(chunk)
+                    size = len(whole) - start
+            else:
+                readinto = getattr(f, "readinto", None)
+                if readinto is not None:
+                    # One reusable buffer instead of a fresh bytes object per chunk
+                    buf = bytearray(_HASH_CHUNK)
+                    view = memoryview(buf)
+                    chunks = (view[:n] for n in iter(lambda: readinto(buf), 0))
+                else:
+                    # SpooledTemporaryFile only has readinto() from Python 3.11
+                    chunks = iter(lambda: f.read(_HASH_CHUNK), b"")
+                for chunk in chunks:
+                    sha_update(chunk)
+                    if md5_update is not None:
+                        md5_update(chunk)
+                    write(chunk)
+                    size += len(chunk)
+            out.flush()
+            sha256_hex = sha256.hexdigest()
+
+            # Keep original extension if any. The stored path is always
+            # "<sha[:2]>/<sha><ext>", so it is built with "/" directly.
+            dot = filename_sanitized.rfind(".")
+            ext = filename_sanitized[dot:] if dot > 0 else ""
+            sha_prefix = sha256_hex[:2]
+            stored_filename = f"{sha256_hex}{ext}"
+            rel_path = f"{sha_prefix}/{stored_filename}"
+            abs_path = upload_dir / sha_prefix / stored_filename
+            try:
+                existing_size = abs_path.stat().st_size
+            except FileNotFoundError:
+                existing_size = None
+            # On a dedup hit the blob is already stored; dropping the temp file
+            # before writeback usually means its pages never reach the disk at all
+            place = existing_size != size
+            if place:
+                if size >= _DROP_CACHE_MIN_SIZE and hasattr(os, "posix_fadvise"):
+                    # DONTNEED only drops clean pages, hence the sync first
+                    os.fdatasync(fd)
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                if tmp_path is None:
+                    _link_unnamed(fd, abs_path)
+        if tmp_path is not None:
+            if place:
+                os.replace(tmp_path, abs_path)
+            else:
+                os.unlink(tmp_path)
+            tmp_path = None
+    except BaseException:
+        if tmp_path is not None:
+            Path(tmp_path).unlink(missing_ok=True)
+        raise
+    md5_hex = md5.hexdigest() if md5 is not None else None
+    return sha256_hex, md5_hex, size, rel_path
+
+
+def _utc_now_iso() -> str:
+    # Same layout as datetime.now(timezone.utc).isoformat(), minus the datetime
+    # object; microseconds are always written, which SQLite's datetime() accepts.
+    s, ns = divmod(time.time_ns(), 1_000_000_000)
+    tm = time.gmtime(s)
+    return (
+        f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+        f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}.{ns // 1000:06d}+00:00"
+    )
 
 
-def store_file(file_storage, filename_sanitized: str) -> tuple[dict, str]:
+def store_file(file_storage, filename_sanitized: str) -> tuple[FileMeta, str]:
     # file_storage is werkzeug FileStorage
-    f = file_storage.stream
-    sha256_hex, md5_hex, size = _hash_fileobj(f)
-
-    # Keep original extension if any
-    ext = os.path.splitext(filename_sanitized)[1]
-    sha_prefix = sha256_hex[:2]
-    stored_filename = f"{sha256_hex}{ext}"
-    rel_path = os.path.join(sha_prefix, stored_filename)
-    abs_dir = Path(current_app.config["UPLOAD_DIR"]) / sha_prefix
-    abs_dir.mkdir(parents=True, exist_ok=True)
-    abs_path = abs_dir / stored_filename
-
-    file_storage.save(abs_path)
-
-    meta = {
-        "filename_original": filename_sanitized,
-        "stored_relpath": rel_path.replace("\\", "/"),
-        "content_type": file_storage.mimetype,
-        "size": size,
-        "sha256": sha256_hex,
-        # MD5 is provided for compatibility display only (non-security)
-        "md5": md5_hex,
-        "uploaded_at": datetime.now(timezone.utc).isoformat(),
-    }
+    sha256_hex, md5_hex, size, rel_path = _hash_and_store(file_storage.stream, filename_sanitized)
+    abs_path = get_paths()["upload"] / rel_path
+
+    meta = FileMeta(
+        filename_original=filename_sanitized,
+        stored_relpath=rel_path,
+        content_type=file_storage.mimetype,
+        size=size,
+        sha256=sha256_hex,
+        md5=md5_hex,
+        uploaded_at=_utc_now_iso(),
+    )
     return meta, str(abs_path)
 
 
@@ -62,19 +279,17 @@ def delete_blob_if_unreferenced(sha256_hex: str, rel_path: str) -> None:
     # Called after DB row removal; only delete blob if no more references to same sha256
     from .db import get_db_connection
 
-    conn = get_db_connection()
-    try:
-        count = conn.execute(
-            "SELECT COUNT(*) FROM files WHERE sha256 = ?", (sha256_hex,)
-        ).fetchone()[0]
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        # Any one row is enough; stops at the first idx_files_sha256 hit
+        referenced = conn.execute(
+            "SELECT 1 FROM files WHERE sha256 = ? LIMIT 1", (sha256_hex,)
+        ).fetchone()
 
-    if count == 0:
-        abs_path = Path(current_app.config["UPLOAD_DIR"]) / rel_path
+    if referenced is None:
+        abs_path = get_paths()["upload"] / rel_path
+        # Prefix dirs are left in place: there are at most 256 of them and most
+        # are shared, so an rmdir here would nearly always fail with ENOTEMPTY
         try:
             abs_path.unlink(missing_ok=True)
-            # Attempt to clean empty prefix dir
-            abs_path.parent.rmdir()
-        except Exception:
-            pass
+        except OSError:
+            logging.warning("Could not delete blob %s", abs_path, exc_info=True)
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from functools import lru_cache
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+_MEDIA_PREVIEWS = frozenset({"image", "audio", "video"})
+
+
+def human_size(num: int) -> str:
+    # Unit index straight from the bit length (every 10 bits is a factor of 1024)
+    i = min((num.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1) if num > 0 else 0
+    return f"{num / (1 << (10 * i)):.2f} {_SIZE_UNITS[i]}"
+
+
+@lru_cache(maxsize=256)
+def preview_class(content_type: str | None) -> str | None:
+    # Which inline preview the detail page shows; uploads reuse a handful of
+    # content types, so the decision is cached per type.
+    ct = content_type or "application/octet-stream"
+    if ct == "application/json":
+        return "json"
+    if ct.startswith("text/") or ct == "application/xml":
+        return "text"
+    major, sep, _ = ct.partition("/")
+    return major if sep and major in _MEDIA_PREVIEWS else None